@@ -0,0 +1,21 @@
+import importlib
+
+# submodules that are only imported the first time they are accessed as
+# attributes of the package, because they pull in ROOT, dask and friends
+lazy_submodules = ("treeview", "hddmview", "cachefile")
+
+def __getattr__(name):
+   """
+   Imports the submodules listed in lazy_submodules on first use, and
+   looks up the package version, so that importing the package itself
+   does neither.
+   """
+   if name in lazy_submodules:
+      return importlib.import_module("." + name, __name__)
+   elif name == "__version__":
+      from ._version import __version__
+      return __version__
+   raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+   return sorted(set(globals()) | set(lazy_submodules) | {"__version__"})
@@ -0,0 +1,3 @@
+# single source of the gluex.jupyroot version number, read by the build
+# from pyproject.toml and by the package at runtime
+__version__ = "1.0.23"
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+#
+# cachefile - registry of the ROOT files (see https://root.cern.ch) that are
+#             used by treeview and hddmview objects to cache their filled
+#             histograms. Each cache file is opened once per process and the
+#             handle is kept open and shared between all of the views that
+#             save into it, instead of reopening the file for every lookup.
+#             Access to the handles and to the ROOT global directory that
+#             goes with them is serialized by a single lock.
+#
+# notes: See "pydoc jupyroot.cachefile" for details of the API.
+
+import ROOT
+import threading
+import atexit
+from collections import namedtuple
+
+lock = threading.RLock()
+openfiles = {}
+compression = 404   # LZ4 at level 4, see ROOT::RCompressionSetting
+
+HistoMeta = namedtuple("HistoMeta", ["name", "title", "classname", "cycle", "datime"])
+
+def key_meta(key):
+   """
+   Returns the HistoMeta summary of the object stored under TKey key,
+   taken from the key alone without reading the object itself.
+   """
+   return HistoMeta(key.GetName(), key.GetTitle(), key.GetClassName(),
+                    key.GetCycle(), key.GetDatime().AsString())
+
+def open_cachefile(path, mode="read"):
+   """
+   Returns the open TFile handle for the ROOT file at path, opening it
+   first if needed. If mode is "update" and the file is currently open
+   read-only then it is closed and reopened for writing, with objects
+   written from then on compressed according to the compression setting
+   of this module. The current ROOT directory is left unchanged. Callers
+   should hold lock while using the handle.
+   """
+   with lock:
+      f = openfiles.get(path)
+      if f and f.IsOpen() and (mode == "read" or f.IsWritable()):
+         return f
+      if f:
+         f.Close()
+      with ROOT.TDirectory.TContext():
+         f = ROOT.TFile.Open(path, mode)
+      if mode != "read":
+         f.SetCompressionSettings(compression)
+      openfiles[path] = f
+      return f
+
+def close_cachefile(path):
+   """
+   Closes the shared TFile handle for the ROOT file at path if it is
+   open, so that any pending writes are committed to disk. The next
+   call to open_cachefile for this path reopens it.
+   """
+   with lock:
+      f = openfiles.pop(path, None)
+      if f and f.IsOpen():
+         with ROOT.TDirectory.TContext():
+            f.Close()
+
+def flush_cachefile(path):
+   """
+   Commits everything written so far through the shared TFile handle
+   for the ROOT file at path to disk, without closing it, so that the
+   file is complete on disk if the process goes away. Does nothing if
+   the handle is not open for writing.
+   """
+   with lock:
+      f = openfiles.get(path)
+      if f and f.IsOpen() and f.IsWritable():
+         with ROOT.TDirectory.TContext():
+            f.Save()
+            f.WriteStreamerInfo()
+            f.Flush()
+
+@atexit.register
+def close_all():
+   """
+   Closes all of the shared TFile handles, called at interpreter exit.
+   """
+   with lock:
+      for path in list(openfiles):
+         close_cachefile(path)
@@ -16,9 +16,6 @@
 # notes: See "pydoc jupyroot.hddmview" for details of the API.
 
 import ROOT
-import dask
-import dask.distributed
-import cloudpickle
 from gluex import hddm_s
 from gluex import hddm_r
 
@@ -27,10 +24,32 @@ import sys
 import socket
 import re
 import math
+import functools
 import uuid
 import glob
+import numpy as np
 
 dask_logdir = ".dask"
+localhost_pattern = re.compile(r"127\.0\.0\.1")
+
+try:
+   import dask
+   import dask.distributed
+except ImportError:
+   dask = None
+
+@functools.lru_cache(maxsize=1)
+def local_fqdn():
+   """
+   Returns the fully qualified domain name of this host, looked up
+   once per process because the DNS query behind it can be slow.
+   """
+   return socket.getfqdn()
+
+from . import cachefile
+
+# histograms made by user initfuncs at declaration time are created here
+scratchdir = ROOT.TDirectory("scratch", "scratch workspace")
 
 class hddmview:
    """
@@ -60,23 +79,22 @@ class hddmview:
       self.inputfiles = inputfiles
       self.memorydir = ROOT.TDirectory(savetoroot.replace('/', '.') + "_resident",
                                        "histograms cached in memory")
-      rootpath = savetoroot.split('/')
-      isfile = 1
-      while os.path.isdir('/'.join(rootpath[:isfile])):
-         isfile += 1
-      self.savetorootfile = '/'.join(rootpath[:isfile])
-      self.savetorootdir = '/'.join(rootpath[isfile:])
-      if os.path.isfile(self.savetorootfile):
-         f = ROOT.TFile(self.savetorootfile, "update")
-         if self.savetorootdir:
-            found = sum([1 for key in f.GetListOfKeys() 
-                         if self.savetorootdir == key.GetName()])
-            if not found:
-               f.mkdir(self.savetorootdir)
+      m = re.match(r"^(.+?\.root)(?:/(.*))?$", savetoroot)
+      if m:
+         self.savetorootfile = m.group(1)
+         self.savetorootdir = m.group(2) or ""
       else:
-         f = ROOT.TFile(self.savetorootfile, "recreate")
-         f.mkdir(self.savetorootdir)
-      f.Close()
+         rootpath = savetoroot.split('/')
+         isfile = 1
+         while os.path.isdir('/'.join(rootpath[:isfile])):
+            isfile += 1
+         self.savetorootfile = '/'.join(rootpath[:isfile])
+         self.savetorootdir = '/'.join(rootpath[isfile:])
+      with cachefile.lock:
+         f = cachefile.open_cachefile(self.savetorootfile, "update")
+         if self.savetorootdir and not f.GetDirectory(self.savetorootdir):
+            f.mkdir(self.savetorootdir)
+         cachefile.close_cachefile(self.savetorootfile)
       self.hddmclass = hddmclass
       try:
          for rec in hddmclass.istream(inputfiles[0]):
@@ -86,7 +104,9 @@ class hddmview:
                           "first element of inputfiles is not a valid",
                           "hddm file of class", hddmclass)
       self.histodefs = {}
+      self._name_index = {}
       self.dask_client = None
+      self._dashboard_link = None
       self.canvases = {}
       self.current_canvas = None
       self.drawn_histos = {}
@@ -102,21 +122,48 @@ class hddmview:
                      fills the histograms from the contents of the hddm record.
       Return value is the count of histograms declared.
       """
-      savedir = ROOT.gDirectory
-      ROOT.gDirectory = ROOT.TDirectory("scratch", "scratch workspace")
       nhistos = 0
-      for hname,histo in initfunc().items():
+      with ROOT.TDirectory.TContext(scratchdir):
+         histos = initfunc()
+      for hname,histo in histos.items():
+         histo.SetDirectory(0)
          if hname != histo.GetName():
             print("hddmview.declare_histograms error -",
                   "histogram", hname, "does not match the ROOT object name",
                   histo.GetName() + ", please fix this and try again.")
-            ROOT.gDirectory = savedir
             return nhistos
          nhistos += 1
-      ROOT.gDirectory = savedir
       self.histodefs[setname] = {'init': initfunc, 'fill': fillfunc, 'filled': {}}
+      self._index_histograms(setname, histos)
+      self.histodefs[setname]['protos'] = histos
       return nhistos
 
+   def _clone_set(self, setname):
+      """
+      Returns a dict of fresh empty histograms for set setname, cloned
+      from the prototypes saved when the set was declared, detached from
+      any ROOT directory.
+      """
+      histos = {hname: proto.Clone() for hname,proto in
+                self.histodefs[setname]['protos'].items()}
+      [histo.SetDirectory(0) for histo in histos.values()]
+      return histos
+
+   def _index_histograms(self, setname, histos):
+      """
+      Records the empty histograms in dict histos, as created by the
+      initfunc of histogram set setname, in the name index that maps each
+      histogram name to its set and an empty prototype of the histogram,
+      so that lookups by name never need to call initfunc again. Entries
+      left over from an earlier declaration of setname are dropped.
+      """
+      self._name_index = {hname: entry for hname,entry in self._name_index.items()
+                          if entry[0] != setname}
+      for hname,histo in histos.items():
+         if histo:
+            histo.SetDirectory(0)
+         self._name_index[hname] = (setname, histo)
+
    def list_histograms(self, cached=False):
       """
       Outputs a list of currently declared histograms managed by this object,
@@ -124,41 +171,34 @@ class hddmview:
       """
       nhistos = 0
       if not cached:
-         savedir = ROOT.gDirectory
-         tmpdir = ROOT.TDirectory("tmp", "temporary for list_histograms")
-         for hset,histodef in self.histodefs.items():
-            ROOT.gDirectory = tmpdir
-            for hname,histo in histodef['init']().items():
-               print("{0:15s}".format(histo.GetName()), end="")
-               print(" {0:60s}".format(histo.GetTitle()), end="")
-               try:
-                  print(" {0}".format(histodef['filled'][hname].GetEntries()))
+         with cachefile.lock:
+            cache = self._open_cache()
+            for hname,(hset,proto) in self._name_index.items():
+               filled = self.histodefs[hset]['filled']
+               print("{0:15s}".format(hname), end="")
+               print(" {0:60s}".format(proto.GetTitle() if proto else ""), end="")
+               if not hname in filled:
+                  h = self._read_cached(cache, hname)
+                  if h:
+                     h.SetDirectory(self.memorydir)
+                     filled[hname] = h
+               if hname in filled:
+                  print(" {0}".format(filled[hname].GetEntries()))
                   nhistos += 1
-               except:
-                  with ROOT.TFile(self.savetorootfile) as fsaved:
-                     if self.savetorootdir:
-                        ROOT.gDirectory.cd(self.savetorootdir)
-                     try:
-                        histodef['filled'][hname] = ROOT.gDirectory.Get(hname)
-                        histodef['filled'][hname].SetDirectory(self.memorydir)
-                        print(" {0}".format(histodef['filled'][hname].GetEntries()))
-                        nhistos += 1
-                     except:
-                        print(" {0}".format(" unfilled"))
-                        del histodef['filled'][hname]
-         ROOT.gDirectory = savedir
+               else:
+                  print(" {0}".format(" unfilled"))
       else:
-         with ROOT.TFile(self.savetorootfile) as fsaved:
-            if self.savetorootdir:
-               ROOT.gDirectory.cd(self.savetorootdir)
-            for key in ROOT.gDirectory.GetListOfKeys():
-                histo = key.ReadObj()
-                if isinstance(histo, ROOT.TH1):
-                   print("{0:15s}".format(histo.GetName() + f";{key.GetCycle()}"), end="")
-                   print(" {0:45s}".format(histo.GetTitle()), end="")
-                   print(" {0:10.0f}".format(histo.GetEntries()), end="")
-                   print("   {0}".format(key.GetDatime().AsString()))
-                   nhistos += 1
+         with cachefile.lock:
+            keys = [cachefile.key_meta(key) for key in self._open_cache().GetListOfKeys()]
+         for meta in keys:
+            # GetClass returns null for classes with no dictionary loaded
+            cl = ROOT.TClass.GetClass(meta.classname)
+            if cl and cl.InheritsFrom("TH1"):
+               print("{0:15s}".format(meta.name + f";{meta.cycle}"), end="")
+               print(" {0:45s}".format(meta.title), end="")
+               print(" {0:10s}".format(meta.classname), end="")
+               print("   {0}".format(meta.datime))
+               nhistos += 1
       return nhistos
 
    def enable_dask_cluster(self, client):
@@ -166,9 +206,14 @@ class hddmview:
       Enable parallel filling of histograms from different input hddm files,
       using a dask cluster session provided by the user, no return value.
       """
+      if dask is None:
+         raise ImportError("hddmview.enable_dask_cluster error - " +
+                           "the dask and distributed packages are required, " +
+                           "install them with pip install gluex.jupyroot[dask]")
       self.dask_client = client
+      self._dashboard_link = localhost_pattern.sub(local_fqdn(), client.dashboard_link)
 
-   def fill_histograms(self, chunksize=1, accumsize=100, **kwargs):
+   def fill_histograms(self, chunksize=1, accumsize=8, **kwargs):
       """
       Scan over the full list of input hddm files and fill all histograms
       that need filling if any, otherwise return immediately. Return value
@@ -179,10 +224,17 @@ class hddmview:
                    only relevant if parallel dask algorithm is enabled
        * accumsize - (int) number of chunks to gather together into a single
                    accumulator step in the sum over parallel dask results,
-                   only relevant if parallel dask algorithm is enabled
+                   at least 2, only relevant if parallel dask algorithm is
+                   enabled
        * kwargs - any number of user-defined keyword arguments to be passed
-                   to the remote worker for use by the user fill function
+                   to the remote workers, where they are added to the global
+                   namespace of the user fill functions, so that a fill
+                   function can refer to kwarg x simply as x; only relevant
+                   if parallel dask algorithm is enabled
       """
+      if accumsize < 2:
+         raise ValueError("hddmview.fill_histograms error - " +
+                          f"accumsize must be at least 2, got {accumsize}")
       workdir = ROOT.TDirectory(self.memorydir.GetName() + "_workspace",
                                 self.memorydir.GetTitle() + "_workspace")
       savedir = ROOT.gDirectory
@@ -195,19 +247,13 @@ class hddmview:
          histos['fill_histograms_stats'].Fill(ifile)
       self.declare_histograms("fill_histograms statistics", fill_histograms_hinit, fill_histograms_hfill)
       ntofill = 0
+      with cachefile.lock:
+         cached = {key.GetName() for key in self._open_cache().GetListOfKeys()}
       for hset,histodef in self.histodefs.items():
-         histos = histodef['init']()
-         with ROOT.TFile.Open(self.savetorootfile) as fsaved:
-            if self.savetorootdir:
-               ROOT.gDirectory.cd(self.savetorootdir)
-            try:
-               histodef['filled'] = {h: ROOT.gDirectory.Get(h) for h in histos}
-               [h.GetTitle() for h in histodef['filled'].values()]
-               histodef['filled'] = {}
-            except:
-               histodef['filled'] = {}
-               histodef['filling'] = histos
-               ntofill += len(histos)
+         histodef['filled'] = {}
+         if not cached.issuperset(histodef['protos']):
+            histodef['filling'] = self._clone_set(hset)
+            ntofill += len(histodef['protos'])
       if ntofill > 0 and self.dask_client is None:
          print("found", ntofill, "histograms that need filling,",
                "doing that now in sequential mode...")
@@ -225,9 +271,9 @@ class hddmview:
                self.dask_dashboard_link())
          unique_logdir = f"{os.getcwd()}/{dask_logdir}/{uuid.uuid4().hex}"
          os.makedirs(unique_logdir, exist_ok=False)
-         my_context = f".dask_context_{id(self)}.pkl"
-         with open(my_context, "wb") as contextf:
-             cloudpickle.dump(kwargs, contextf)
+         # send the user kwargs to each worker once, wrapped in a list
+         # so that scatter does not treat the dict as a mapping of keys
+         my_context = self.dask_client.scatter([kwargs], broadcast=True)[0]
          if chunksize > 0:
             results = [dask.delayed(dask_hddmplayer)(j, self.inputfiles[j:j+chunksize],
                                                      hddm_s, self.histodefs, 
@@ -237,38 +283,39 @@ class hddmview:
          else:
             raise ValueError("hddmview.fill_histogram error -",
                              "non-positive chunksize is not supported in this release")
-         while len(results) > accumsize:
-            results = [dask.delayed(dask_collector)(results[i*accumsize:(i+1)*accumsize])
-                       for i in range((len(results) + accumsize - 1) // accumsize)]
-         lastround = dask.delayed(dask_collector)(results)
-         for hset,histodef in lastround.compute().items():
+         lastround = dask_reduce(results, accumsize)
+         resultsum, = dask.compute(lastround, scheduler=self.dask_client)
+         for hset,histodef in resultsum.items():
             if 'filling' in histodef:
                self.histodefs[hset]['filling'] = histodef['filling']
-         self.dask_client.cancel(lastround)
-         os.remove(my_context)
+         self.dask_client.cancel(my_context)
          for badf in glob.glob(f"{unique_logdir}/*"):
             badfile = badf.split('/')[-1]
             print(f"warning: error processing input file {badfile}")
             os.unlink(badf)
          os.rmdir(unique_logdir)
-      with ROOT.TFile.Open(self.savetorootfile, "update") as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
-         for histodef in self.histodefs.values():
-            if 'filling' in histodef:
-               for h in histodef['filling'].values():
-                  if isinstance(h, ROOT.TTree):
-                     dst_tree = h.CloneTree()
-                     dst_tree.Write()
-                  else:
-                     h.Write()
-                  h.SetDirectory(self.memorydir)
-                  #print("filled histogram", h.GetName(), "with", h.GetEntries(), "entries")
-               histodef['filled'] = histodef['filling']
-               del histodef['filling']
+      with cachefile.lock:
+         cache = self._open_cache("update")
+         with ROOT.TDirectory.TContext(cache):
+            for histodef in self.histodefs.values():
+               if 'filling' in histodef:
+                  for h in histodef['filling'].values():
+                     if isinstance(h, ROOT.TTree):
+                        dst_tree = h.CloneTree()
+                        dst_tree.Write()
+                     else:
+                        cache.WriteTObject(h, h.GetName(), "Overwrite")
+                     h.SetDirectory(self.memorydir)
+                     #print("filled histogram", h.GetName(), "with", h.GetEntries(), "entries")
+                  histodef['filled'] = histodef['filling']
+                  del histodef['filling']
+         cachefile.close_cachefile(self.savetorootfile)
       hprocstats = self.get('fill_histograms_stats')
-      nfiles = sum([1 for i in range(nfiles) if hprocstats.GetBinContent(i+1) > 0])
-      nrecords = hprocstats.Integral()
+      counts = hprocstats.GetArray()
+      counts.reshape((hprocstats.GetNcells(),))
+      counts = np.frombuffer(counts, dtype=np.float64)[1:nfiles+1]
+      nfiles = int(np.count_nonzero(counts))
+      nrecords = float(counts.sum())
       print(f"fill_histograms read a total of {nfiles} tree files, {nrecords} records")
       #workdir.ls()
       savedir.cd()
@@ -332,8 +379,35 @@ class hddmview:
       ROOT.gStyle.SetOptTitle(titles)
       ROOT.gStyle.SetOptStat(stats)
       ROOT.gStyle.SetOptFit(fits)
-      badoption = 0
+      nx, ny, plan = self._normalize_histos(histos, options)
+      cname = self.setup_canvas(width=width*max(nx, 1), height=height*max(ny, 1))
+      if nx > 0:
+         self.current_canvas.Divide(nx, max(ny, 1))
       nhistos = 0
+      found = self._get_many([hname for pad,cell in plan for hname,option in cell])
+      for pad,cell in plan:
+         self.current_canvas.cd(pad)
+         for hname,option in cell:
+            histo = found[hname]
+            if not histo:
+               break
+            histo.Draw(option)
+            nhistos += 1
+            self.drawn_histos[histo.GetName()] = histo
+      self.current_canvas.cd(0)
+      self.current_canvas.Draw()
+      return nhistos
+
+   def _normalize_histos(self, histos, options):
+      """
+      Checks that the histos and options arguments to draw have the same
+      shape and flattens them into a plan for drawing the canvas. Return
+      value is the tuple (nx, ny, plan), where nx and ny are the number
+      of columns and rows the canvas is divided into (0 if not divided)
+      and plan is a list of (pad, cell) pairs, with each cell being the
+      list of (hname, option) pairs to be drawn on that pad, in order.
+      """
+      badoption = 0
       if isinstance(histos, list):
          ny = len(histos)
          if isinstance(options, list):
@@ -368,117 +442,120 @@ class hddmview:
          raise ValueError("arguments histos and options must have " +
                           "the same shape if either one of them " +
                           f"is an array or a list ({badoption})")
+      plan = []
       if nx == 0 and ny == 0:
-         cname = self.setup_canvas(width=width, height=height)
          if len(histos) > 0:
-            histo = self.get(histos)
-            if histo:
-               histo.Draw(options)
-               nhistos += 1
-               self.drawn_histos[histo.GetName()] = histo
+            plan.append((0, [(histos, options)]))
       elif ny == 0:
-         cname = self.setup_canvas(width=width*nx, height=height)
-         self.current_canvas.Divide(nx, 1)
          for ix in range(nx):
-            self.current_canvas.cd(ix + 1)
-            histo = self.get(histos[ix])
-            if histo:
-               if isinstance(options, list):
-                  histo.Draw(options[ix])
-               else:
-                  histo.Draw(options)
-               nhistos += 1
-               self.drawn_histos[histo.GetName()] = histo
+            option = options[ix] if isinstance(options, list) else options
+            plan.append((ix + 1, [(histos[ix], option)]))
       else:
-         cname = self.setup_canvas(width=width*nx, height=height*ny)
-         self.current_canvas.Divide(nx, ny)
          for iy in range(ny):
-            for ix in range(nx):
-                try:
-                  self.current_canvas.cd(iy * nx + ix + 1)
+            for ix in range(len(histos[iy])):
+               cell = histos[iy][ix]
+               if not isinstance(cell, list):
+                  cell = [cell]
+               option = options
+               if isinstance(options, list):
+                  try:
+                     option = options[iy][ix]
+                  except IndexError:
+                     continue
                   if isinstance(histos[iy][ix], list):
-                     histo = self.get(histos[iy][ix][0])
-                     if not histo:
-                        pass
-                     elif isinstance(options, list):
-                        histo.Draw(options[iy][ix][0])
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                        for i in range(1,len(histos[iy][ix])):
-                           histo = self.get(histos[iy][ix][i])
-                           histo.Draw(options[iy][ix][0] + " same")
-                           nhistos += 1
-                           self.drawn_histos[histo.GetName()] = histo
-                     else:
-                        histo.Draw(options)
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                        for i in range(1,len(histos[iy][ix])):
-                           histo = self.get(histos[iy][ix][i])
-                           histo.Draw(options + " same")
-                           nhistos += 1
-                           self.drawn_histos[histo.GetName()] = histo
-                  else:
-                     histo = self.get(histos[iy][ix])
-                     if not histo:
-                        pass
-                     elif isinstance(options, list):
-                        histo.Draw(options[iy][ix])
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                     else:
-                        histo.Draw(options)
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                except:
-                  pass
-      self.current_canvas.cd(0)
-      self.current_canvas.Draw()
-      return nhistos
+                     option = option[0]
+               plan.append((iy * nx + ix + 1,
+                            [(hname, option + " same" if i > 0 else option)
+                             for i,hname in enumerate(cell)]))
+      return nx, ny, plan
 
-   def get(self, hname):
+   def get(self, hname, meta_only=False):
       """
       Look for histogram named hname in the cache and return if found,
       otherwise look for an empty histogram in the defined histodefs
       with this name and return the empty copy, else report error and
-      return None.
+      return None. If meta_only is True then the histogram is not read,
+      and instead a cachefile.HistoMeta tuple with its name, title,
+      class name, cycle and date taken from the cache file directory is
+      returned, or None if it is not in the cache.
       """
-      with ROOT.TFile(self.savetorootfile) as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
-         try:
-            h = ROOT.gDirectory.Get(hname)
-            if h:
-               h.SetDirectory(self.memorydir)
-            else:
-               raise ValueError(f"histogram {hname} not found")
-            return h
-         except:
-            pass
-      h = None
-      for hset,histoset in self.histodefs.items():
-         for histo in histoset['init']().values():
-            if hname == histo.GetName():
-               h = histo
-               break
-      if h:
-         h.SetDirectory(self.memorydir)
-      return h
+      if meta_only:
+         with cachefile.lock:
+            key = self._open_cache().GetKey(hname)
+            return cachefile.key_meta(key) if key else None
+      return self._get_many([hname])[hname]
+
+   def _get_many(self, hnames):
+      """
+      Looks up each of the histograms named in list hnames the same way
+      as get, reading all of those that are not already in memory from
+      the cache file in one pass under a single hold of the cache lock.
+      Return value is a dict of the results keyed by name.
+      """
+      found = {}
+      with cachefile.lock:
+         cache = None
+         for hname in dict.fromkeys(hnames):
+            hset, proto = self._name_index.get(hname, (None, None))
+            h = self.histodefs[hset]['filled'].get(hname) if hset else None
+            if not h:
+               if cache is None:
+                  cache = self._open_cache()
+               h = self._read_cached(cache, hname)
+               if h:
+                  h.SetDirectory(self.memorydir)
+                  if hset:
+                     self.histodefs[hset]['filled'][hname] = h
+               elif proto:
+                  h = proto.Clone()
+                  h.SetDirectory(self.memorydir)
+            found[hname] = h
+      return found
 
    def put(self, hist):
       """
       Save histogram hist in the cache root directory, and
-      return True for success, False for failure.
+      return True for success, False for failure. The cache file
+      is left open for writing, see flush.
       """
-      with ROOT.TFile(self.savetorootfile, "update") as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
+      with cachefile.lock:
          try:
-            hist.Write()
+            with ROOT.TDirectory.TContext(self._open_cache("update")):
+               hist.Write()
          except:
             return False
       return True
 
+   def flush(self):
+      """
+      Commits any histograms saved with put to the cache file on disk,
+      leaving it open. Open cache files are also closed automatically
+      when the python interpreter exits.
+      """
+      cachefile.flush_cachefile(self.savetorootfile)
+
+   def _open_cache(self, mode="read"):
+      """
+      Returns the directory in the shared open handle on the cache file
+      where this object saves its histograms, opened in the given mode,
+      see cachefile.open_cachefile. Callers should hold cachefile.lock.
+      """
+      f = cachefile.open_cachefile(self.savetorootfile, mode)
+      if self.savetorootdir:
+         return f.GetDirectory(self.savetorootdir)
+      return f
+
+   def _read_cached(self, cache, hname):
+      """
+      Reads the latest cycle of object hname from directory cache on
+      disk, bypassing any copy left in memory from an earlier read of
+      the same handle, returns None if it is not there.
+      """
+      key = cache.GetKey(hname)
+      if key:
+         return key.ReadObj()
+      return None
+
    def dask_dashboard_link(self):
       """
       The default behavior of the dask client is to provide a local url for
@@ -487,7 +564,7 @@ class hddmview:
       assuming the jupyterhub host is not blocked by internet firewalls.
       """
       if self.dask_client:
-         return re.sub("127.0.0.1", socket.getfqdn(), self.dask_client.dashboard_link)
+         return self._dashboard_link
       else:
          return None
 
@@ -514,6 +591,19 @@ class hddmview:
             else:
                print(f"      '{keyword}':", histodef[keyword])
 
+def inject_context(histodefs, context):
+   """
+   Static member function of hddmview, called on a dask worker to make
+   the user kwargs of fill_histograms in dict context visible to the
+   user fill functions in histodefs, by adding them to the global
+   namespace of each fill function as it exists on the worker. The
+   internal fill_histograms statistics set is skipped.
+   """
+   for hset,histodef in histodefs.items():
+      fill = histodef.get('fill')
+      if hset != "fill_histograms statistics" and hasattr(fill, "__globals__"):
+         fill.__globals__.update(context)
+
 def dask_hddmplayer(j, infiles, hddmclass, histodefs, logdir=None, context=None):
    """
    Static member function of hddmview, called with dask_delayed
@@ -526,14 +616,13 @@ def dask_hddmplayer(j, infiles, hddmclass, histodefs, logdir=None, context=None)
                   histograms being filled under the key 'filling'.
     5. logdir - path of a directory to save logs of any input files
                   that generated errors or crashed during processing.
-    6. context - name of a pickle file with a readonly dict containing
-                 variables that are needed by the user fill function.
+    6. context - readonly dict, scattered to the workers, of the user
+                 kwargs to fill_histograms, which are made visible to the
+                 user fill functions as globals, see inject_context.
    Return value is the updated histodefs from argument 4.
    """
    if context:
-      with open(context, "rb") as contextf:
-         kwargs = cloudpickle.load(contextf)
-         locals().update(kwargs)
+      inject_context(histodefs, context)
    def loop_over_events(infile):
       nerrors = 0
       for rec in hddmclass.istream(infile):
@@ -566,6 +655,22 @@ def dask_hddmplayer(j, infiles, hddmclass, histodefs, logdir=None, context=None)
       j += 1
    return histodefs
 
+def dask_reduce(results, accumsize):
+   """
+   Static member function of hddmview, builds a balanced tree of
+   dask_delayed dask_collector steps that sums the list of delayed
+   results, with no more than accumsize inputs to any one step, so
+   that the depth of the tree grows only as log(len(results)) and
+   no single worker ever holds more than accumsize partial sums.
+   The accumsize must be at least 2 for the tree to get shallower.
+   Return value is the delayed object for the final sum.
+   """
+   if len(results) > accumsize:
+      step = math.ceil(len(results) / accumsize)
+      results = [dask_reduce(results[i:i+step], accumsize)
+                 for i in range(0, len(results), step)]
+   return dask.delayed(dask_collector)(results)
+
 def dask_collector(results):
    """
    Static member function of hddmview, called with dask_delayed
@@ -576,16 +681,11 @@ def dask_collector(results):
    resultsum = results[0]
    for hset in resultsum:
       if 'filling' in resultsum[hset]:
-         for h in resultsum[hset]['filling']:
-            if isinstance(resultsum[hset]['filling'][h], ROOT.TTree):
-               tree_one = resultsum[hset]['filling'][h]
-               dst_tree = tree_one.CloneTree(0)
-               for result in results[1:]:
-                  src_tree = result[hset]['filling'][h]
-                  tree_one.CopyAddresses(src_tree)
-                  for row in src_tree:
-                     tree_one.Fill()
-            else:
-               for result in results[1:]:
-                  resultsum[hset]['filling'][h].Add(result[hset]['filling'][h])
+         fillings = [result[hset]['filling'] for result in results[1:]]
+         for h,dst in resultsum[hset]['filling'].items():
+            # TH1::Merge sums the bin contents, TTree::Merge appends the rows
+            others = ROOT.TList()
+            for filling in fillings:
+               others.Add(filling[h])
+            dst.Merge(others)
    return resultsum
@@ -16,10 +16,7 @@
 # notes: See "pydoc jupyroot.treeview" for details of the API.
 
 import ROOT
-import dask
-import dask.distributed
-import cloudpickle
-from pyxrootd import client as xclient
+from XRootD import client as xclient
 import IPython.display
 import inspect
 import ctypes
@@ -30,15 +27,53 @@ import sys
 import socket
 import re
 import math
+import functools
+import weakref
 import uuid
 import glob
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 dask_logdir = ".dask"
+localhost_pattern = re.compile(r"127\.0\.0\.1")
+uproot_step_size = "100 MB"
+treecache_size = 50000000
+dask_target_tasktime = 30
+fill_error_limit = 1000
+xrd_stream_timeout = 60
+logger = logging.getLogger("distributed.worker")
+
+try:
+   import dask
+   import dask.distributed
+except ImportError:
+   dask = None
+
+try:
+   import uproot
+except ImportError:
+   uproot = None
 
 import numpy as np
 from array import array
 from types import SimpleNamespace
 
+from . import cachefile
+
+# histograms made by user initfuncs at declaration time are created here
+scratchdir = ROOT.TDirectory("scratch", "scratch workspace")
+
+@functools.lru_cache(maxsize=1)
+def local_fqdn():
+   """
+   Returns the fully qualified domain name of this host, looked up
+   once per process because the DNS query behind it can be slow.
+   """
+   return socket.getfqdn()
+
 def parse_root_struct_to_dtype(format_string):
     """
     Converts a ROOT format string (leaf-list) into a NumPy dtype list.
@@ -78,6 +113,93 @@ def parse_root_struct_to_dtype(format_string):
             
     return dtype_list
 
+def uproot_iterate(infiles, histodefs):
+   """
+   Iterates with uproot over the rows of the input tree in chunks of
+   uproot_step_size, yielding for each chunk a dict of numpy arrays
+   with the contents of all branches needed by the columnar histogram
+   sets in histodefs. Argument infiles is a list of (filename, treename)
+   pairs. Inputs served over http, s3 or gcs are read through fsspec,
+   which issues many concurrent range requests, and decompression and
+   interpretation of baskets are spread over a pool of threads.
+   """
+   branches = {branch: 1 for histodef in histodefs.values()
+               for branch in histodef['branches']}
+   options = {}
+   if infiles and infiles[0][0].startswith(("http", "s3", "gcs")):
+      options['handler'] = uproot.source.fsspec.FSSpecSource
+   with ThreadPoolExecutor(4) as decompressor, ThreadPoolExecutor(4) as interpreter:
+      for arrays in uproot.iterate(dict(infiles), list(branches.keys()),
+                                   step_size=uproot_step_size, library="np",
+                                   decompression_executor=decompressor,
+                                   interpretation_executor=interpreter,
+                                   **options):
+         yield arrays
+
+def fill_columnar_chunk(histos, filldata):
+   """
+   Fills the histograms in dict histos in bulk from the numpy arrays
+   returned by a columnar kernel for one chunk of rows, with a single
+   call to TH1::FillN per histogram. The filldata argument is a dict
+   keyed by histogram name, with values (x, w) for 1D histograms or
+   (x, y, w) for 2D histograms, where w can be a numpy array, a scalar
+   weight applied to all rows in the chunk, or None for unit weights.
+   """
+   for hname,cols in filldata.items():
+      x = np.require(cols[0], np.float64, ['C', 'W'])
+      n = len(x)
+      if n == 0:
+         continue
+      w = cols[-1] if len(cols) > 1 else None
+      if w is None:
+         w = ROOT.nullptr
+      else:
+         w = np.require(np.broadcast_to(w, x.shape), np.float64, ['C', 'W'])
+      if len(cols) > 2:
+         y = np.require(cols[1], np.float64, ['C', 'W'])
+         histos[hname].FillN(n, x, y, w)
+      else:
+         histos[hname].FillN(n, x, w)
+
+def fill_columnar_set(histodef, histos, arrays):
+   """
+   Fills the histograms in dict histos of one columnar set from the dict
+   of numpy arrays for one chunk of rows, either by passing the arrays
+   and histograms to the vectorized fill function of a set declared with
+   declare_histograms_vec, or through fill_columnar_chunk with the output
+   of the kernel of a set declared with declare_columnar_histograms.
+   """
+   if histodef.get('vecfill'):
+      histodef['vecfill'](arrays, histos)
+   else:
+      fill_columnar_chunk(histos, histodef['kernel'](arrays))
+
+# patterns used by treeview.inspect_source, and its results by fillfunc
+vargrp = r"([A-Za-z_][A-Za-z0-9_]*)"
+nvarchar = r"[^A-Za-z0-9_]"
+fillfunc_def_pattern = re.compile(f"def[\\s]+{vargrp}[\\s]*\\([\\s]*{vargrp}[\\s]*," +
+                                  f"[\\s]*{vargrp}[\\s]*[,)]")
+getleaf_pattern = re.compile(f"\\.GetLeaf\\([\"']{vargrp}[\"']\\)")
+rowarg_patterns = {}
+inspected_leaves = weakref.WeakKeyDictionary()
+
+def leaf_branches(tree):
+   """
+   Returns a dict mapping the name of every leaf of ROOT tree or chain
+   tree to the branch that holds it, built in one pass over the branches.
+   """
+   return {leaf.GetName(): branch for branch in tree.GetListOfBranches()
+           for leaf in branch.GetListOfLeaves()}
+
+def branches_of_leaves(tree, leaves):
+   """
+   Returns the list of names of the branches of ROOT tree or chain tree
+   that hold the leaves named in leaves, each branch listed once.
+   """
+   leafmap = leaf_branches(tree)
+   return list(dict.fromkeys(leafmap[lname].GetName() for lname in leaves
+                             if lname in leafmap))
+
 ROOT_TYPE_MAP = {
     "Int_t": "i",
     "UInt_t": "I",
@@ -100,6 +222,11 @@ class treeview:
    input tree chain.
    """
 
+   __slots__ = ('inputchain', 'memorydir', 'savetorootfile', 'savetorootdir',
+                'rdf_results', 'histodefs', '_name_index', 'dask_client',
+                '_file_to_worker', '_dashboard_link',
+                'canvases', 'current_canvas', 'drawn_histos')
+
    def __init__(self, treechain, savetoroot):
       """
       Constructor required arguments:
@@ -114,26 +241,28 @@ class treeview:
       self.inputchain = treechain
       self.memorydir = ROOT.TDirectory(savetoroot.replace('/', '.') + "_resident",
                                        "histograms cached in memory")
-      rootpath = savetoroot.split('/')
-      isfile = 1
-      while os.path.isdir('/'.join(rootpath[:isfile])):
-         isfile += 1
-      self.savetorootfile = '/'.join(rootpath[:isfile])
-      self.savetorootdir = '/'.join(rootpath[isfile:])
-      if os.path.isfile(self.savetorootfile):
-         f = ROOT.TFile(self.savetorootfile, "update")
-         if self.savetorootdir:
-            found = sum([1 for key in f.GetListOfKeys() 
-                         if self.savetorootdir == key.GetName()])
-            if not found:
-               f.mkdir(self.savetorootdir)
+      m = re.match(r"^(.+?\.root)(?:/(.*))?$", savetoroot)
+      if m:
+         self.savetorootfile = m.group(1)
+         self.savetorootdir = m.group(2) or ""
       else:
-         f = ROOT.TFile(self.savetorootfile, "recreate")
-         f.mkdir(self.savetorootdir)
-      f.Close()
+         rootpath = savetoroot.split('/')
+         isfile = 1
+         while os.path.isdir('/'.join(rootpath[:isfile])):
+            isfile += 1
+         self.savetorootfile = '/'.join(rootpath[:isfile])
+         self.savetorootdir = '/'.join(rootpath[isfile:])
+      with cachefile.lock:
+         f = cachefile.open_cachefile(self.savetorootfile, "update")
+         if self.savetorootdir and not f.GetDirectory(self.savetorootdir):
+            f.mkdir(self.savetorootdir)
+         cachefile.close_cachefile(self.savetorootfile)
       self.rdf_results = {}
       self.histodefs = {}
+      self._name_index = {}
       self.dask_client = None
+      self._dashboard_link = None
+      self._file_to_worker = {}
       self.canvases = {}
       self.current_canvas = None
       self.drawn_histos = {}
@@ -168,7 +297,7 @@ class treeview:
             return None
       return hcached
 
-   def declare_histograms(self, setname, initfunc, fillfunc, leaves=[]):
+   def declare_histograms(self, setname, initfunc, fillfunc, leaves=[], safe=False):
       """
       Declares a list of user-defined histogram to treeview, with arguments:
        1. setname =  user-defined unique name for this set of histograms
@@ -185,27 +314,165 @@ class treeview:
                      list can be explicitly provided by the user in case
                      the automatic algorithm (see method inspect_source)
                      is inadequate.
+       5. safe =     set to True if fillfunc is known never to raise an
+                     exception, so that the dask workers can call it without
+                     catching and counting errors on every row.
       Return value is the count of histograms declared.
       """
-      savedir = ROOT.gDirectory
-      ROOT.gDirectory = ROOT.TDirectory("scratch", "scratch workspace")
       nhistos = 0
-      for hname,histo in initfunc().items():
+      with ROOT.TDirectory.TContext(scratchdir):
+         histos = initfunc()
+      for hname,histo in histos.items():
+         histo.SetDirectory(0)
          if hname != histo.GetName():
             print("treeview.declare_histograms error -",
                   "histogram", hname, "does not match the ROOT object name",
                   histo.GetName() + ", please fix this and try again.")
-            ROOT.gDirectory = savedir
             return nhistos
          nhistos += 1
-      ROOT.gDirectory = savedir
-      self.histodefs[setname] = {'init': initfunc, 'fill': fillfunc, 'filled': {}}
+      self.histodefs[setname] = {'init': initfunc, 'fill': fillfunc, 'filled': {},
+                                 'safe': safe}
+      self._index_histograms(setname, histos)
+      self.histodefs[setname]['protos'] = histos
       if len(leaves) > 0:
          self.histodefs[setname]['leaves'] = leaves
       else:
          self.histodefs[setname]['leaves'] = self.inspect_source(fillfunc)
       return nhistos
 
+   def _clone_set(self, setname):
+      """
+      Returns a dict of fresh empty histograms for set setname, cloned
+      from the prototypes saved when the set was declared, detached from
+      any ROOT directory.
+      """
+      histos = {hname: proto.Clone() for hname,proto in
+                self.histodefs[setname]['protos'].items()}
+      [histo.SetDirectory(0) for histo in histos.values()]
+      return histos
+
+   def _index_histograms(self, setname, histos):
+      """
+      Records the empty histograms in dict histos, as created by the
+      initfunc of histogram set setname, in the name index that maps each
+      histogram name to its set and an empty prototype of the histogram,
+      so that lookups by name never need to call initfunc again. Entries
+      left over from an earlier declaration of setname are dropped.
+      """
+      self._name_index = {hname: entry for hname,entry in self._name_index.items()
+                          if entry[0] != setname}
+      for hname,histo in histos.items():
+         if histo:
+            histo.SetDirectory(0)
+         self._name_index[hname] = (setname, histo)
+
+   def declare_rdf_histograms(self, setname, bookfunc):
+      """
+      Declares a list of user-defined histograms to treeview that are filled
+      by ROOT RDataFrame instead of a python fill function, with arguments:
+       1. setname =  user-defined unique name for this set of histograms
+       2. bookfunc = user-defined function that accepts a ROOT.RDataFrame
+                     built on the input tree chain, books the histograms on
+                     it using the RDataFrame Define/Filter/Histo* methods,
+                     and returns a dict of the resulting RResultPtr handles
+                     keyed by histogram name
+      All sets declared this way are filled together in a single implicitly
+      multithreaded pass over the input chain by fill_histograms, without
+      any per-row python calls.
+      Return value is the count of histograms declared.
+      """
+      rdf = ROOT.RDataFrame(self.inputchain)
+      hnames = list(bookfunc(rdf).keys())
+      self.histodefs[setname] = {'book': bookfunc, 'names': hnames,
+                                 'filled': {}, 'leaves': []}
+      self._index_histograms(setname, {hname: None for hname in hnames})
+      return len(hnames)
+
+   def declare_histograms_rdf(self, setname, defines, hist_specs):
+      """
+      Declares a list of user-defined histograms to treeview that are filled
+      by ROOT RDataFrame from column expressions, with arguments:
+       1. setname =  user-defined unique name for this set of histograms
+       2. defines =  list of (name, expr) pairs, each defining a new column
+                     with RDataFrame.Define from a C++ expression of the
+                     columns of the input tree and the columns defined
+                     before it in the list
+       3. hist_specs = list of (model, column, ...) tuples, where model is
+                     a tuple (name, title, nbins, low, high) for a TH1D or
+                     (name, title, nbinsx, xlow, xhigh, nbinsy, ylow, yhigh)
+                     for a TH2D, followed by the names of the columns to
+                     fill it with, x [y] [weight]
+      This is a shorthand for declare_rdf_histograms with a bookfunc that
+      applies the defines and books one Histo1D or Histo2D per spec.
+      Return value is the count of histograms declared.
+      """
+      defines = list(defines)
+      hist_specs = list(hist_specs)
+      def bookfunc(rdf):
+         for name,expr in defines:
+            rdf = rdf.Define(name, expr)
+         results = {}
+         for model,*columns in hist_specs:
+            if len(model) > 5:
+               results[model[0]] = rdf.Histo2D(tuple(model), *columns)
+            else:
+               results[model[0]] = rdf.Histo1D(tuple(model), *columns)
+         return results
+      return self.declare_rdf_histograms(setname, bookfunc)
+
+   def declare_columnar_histograms(self, setname, initfunc, kernel, branches):
+      """
+      Declares a list of user-defined histograms to treeview that are filled
+      in bulk from numpy arrays instead of one row at a time, with arguments:
+       1. setname =  user-defined unique name for this set of histograms
+       2. initfunc = user-defined function that creates an empty instance of
+                     these histograms with title and axis labels assigned
+       3. kernel =   user-defined function that accepts a dict of numpy
+                     arrays keyed by branch name, holding the contents of
+                     those branches for a chunk of consecutive rows, and
+                     returns a dict keyed by histogram name with values
+                     (x, w) of numpy arrays to fill into 1D histograms, or
+                     (x, y, w) for 2D histograms, see fill_columnar_chunk
+       4. branches = list of the names of branches of the input tree that
+                     are needed by kernel
+      The input chain is read with uproot, which must be installed in order
+      to use this method.
+      Return value is the count of histograms declared.
+      """
+      if uproot is None:
+         raise ImportError("treeview.declare_columnar_histograms error - " +
+                           "the uproot package is required for columnar fills")
+      nhistos = self.declare_histograms(setname, initfunc, None, leaves=["NULL"],
+                                        safe=True)
+      if setname in self.histodefs:
+         self.histodefs[setname]['kernel'] = kernel
+         self.histodefs[setname]['vecfill'] = None
+         self.histodefs[setname]['branches'] = branches
+      return nhistos
+
+   def declare_histograms_vec(self, setname, initfunc, vec_fillfunc, branches):
+      """
+      Declares a list of user-defined histograms to treeview that are filled
+      in bulk from numpy arrays by a user function, with arguments:
+       1. setname =  user-defined unique name for this set of histograms
+       2. initfunc = user-defined function that creates an empty instance of
+                     these histograms with title and axis labels assigned
+       3. vec_fillfunc = user-defined function that accepts a dict of numpy
+                     arrays keyed by branch name, holding the contents of
+                     those branches for a chunk of consecutive rows, and the
+                     dict of histograms to be filled, and fills them from the
+                     arrays, typically with TH1::FillN
+       4. branches = list of the names of branches of the input tree that
+                     are needed by vec_fillfunc
+      This is the same as declare_columnar_histograms except that the user
+      function fills the histograms itself, and it also requires uproot.
+      Return value is the count of histograms declared.
+      """
+      nhistos = self.declare_columnar_histograms(setname, initfunc, None, branches)
+      if setname in self.histodefs:
+         self.histodefs[setname]['vecfill'] = vec_fillfunc
+      return nhistos
+
    def inspect_source(self, fillfunc):
       """
       Scans the source of fillfunc for the names of columns in the input tree
@@ -213,21 +480,20 @@ class treeview:
       phase, only those columns will be read during query processing, which
       can significantly speed up data access in common analysis scenarios.
       """
+      if fillfunc in inspected_leaves:
+         return list(inspected_leaves[fillfunc])
       source_code = inspect.getsource(fillfunc)
-      vargrp = r"([A-Za-z_][A-Za-z0-9_]*)"
-      nvarchar = r"[^A-Za-z0-9_]"
-      m1 = re.match(f"def[\\s]+{vargrp}[\\s]*\([\\s]*{vargrp}[\\s]*," +
-                    f"[\\s]*{vargrp}[\\s]*[,)]", source_code)
+      m1 = fillfunc_def_pattern.match(source_code)
       if m1:
          ffname = m1.group(1)
          rowarg = m1.group(2)
       else:
          raise ValueError("User fillfunc must start with a python function def")
-      columns = {}
-      for var in re.findall(f"{nvarchar}{rowarg}\\.{vargrp}", source_code):
-         columns[var] = 1
-      for var in re.findall(f"\.GetLeaf\([\"']{vargrp}[\"']\)", source_code):
-         columns[var] = 1
+      if not rowarg in rowarg_patterns:
+         rowarg_patterns[rowarg] = re.compile(f"{nvarchar}{rowarg}\\.{vargrp}")
+      columns = dict.fromkeys(rowarg_patterns[rowarg].findall(source_code))
+      columns.update(dict.fromkeys(getleaf_pattern.findall(source_code)))
+      inspected_leaves[fillfunc] = list(columns.keys())
       return list(columns.keys())
 
    def list_histograms(self, cached=False):
@@ -237,69 +503,113 @@ class treeview:
       """
       nhistos = 0
       if not cached:
-         savedir = ROOT.gDirectory
-         tmpdir = ROOT.TDirectory("tmp", "temporary for list_histograms")
-         for hset,histodef in self.histodefs.items():
-            ROOT.gDirectory = tmpdir
-            for hname,histo in histodef['init']().items():
-               print("{0:15s}".format(histo.GetName()), end="")
-               print(" {0:60s}".format(histo.GetTitle()), end="")
-               try:
-                  print(" {0}".format(histodef['filled'][hname].GetEntries()))
+         with cachefile.lock:
+            cache = self._open_cache()
+            for hname,(hset,proto) in self._name_index.items():
+               filled = self.histodefs[hset]['filled']
+               print("{0:15s}".format(hname), end="")
+               print(" {0:60s}".format(proto.GetTitle() if proto else ""), end="")
+               if not hname in filled:
+                  h = self._read_cached(cache, hname)
+                  if h:
+                     h.SetDirectory(self.memorydir)
+                     filled[hname] = h
+               if hname in filled:
+                  print(" {0}".format(filled[hname].GetEntries()))
                   nhistos += 1
-               except:
-                  with ROOT.TFile(self.savetorootfile) as fsaved:
-                     if self.savetorootdir:
-                        ROOT.gDirectory.cd(self.savetorootdir)
-                     try:
-                        histodef['filled'][hname] = ROOT.gDirectory.Get(hname)
-                        histodef['filled'][hname].SetDirectory(self.memorydir)
-                        print(" {0}".format(histodef['filled'][hname].GetEntries()))
-                        nhistos += 1
-                     except:
-                        print(" {0}".format(" unfilled"))
-                        del histodef['filled'][hname]
-         ROOT.gDirectory = savedir
+               else:
+                  print(" {0}".format(" unfilled"))
       else:
-         with ROOT.TFile(self.savetorootfile) as fsaved:
-            if self.savetorootdir:
-               ROOT.gDirectory.cd(self.savetorootdir)
-            for key in ROOT.gDirectory.GetListOfKeys():
-                histo = key.ReadObj()
-                if isinstance(histo, ROOT.TH1):
-                   print("{0:15s}".format(histo.GetName() + f";{key.GetCycle()}"), end="")
-                   print(" {0:45s}".format(histo.GetTitle()), end="")
-                   print(" {0:10.0f}".format(histo.GetEntries()), end="")
-                   print("   {0}".format(key.GetDatime().AsString()))
-                   nhistos += 1
+         with cachefile.lock:
+            keys = [cachefile.key_meta(key) for key in self._open_cache().GetListOfKeys()]
+         for meta in keys:
+            # GetClass returns null for classes with no dictionary loaded
+            cl = ROOT.TClass.GetClass(meta.classname)
+            if cl and cl.InheritsFrom("TH1"):
+               print("{0:15s}".format(meta.name + f";{meta.cycle}"), end="")
+               print(" {0:45s}".format(meta.title), end="")
+               print(" {0:10s}".format(meta.classname), end="")
+               print("   {0}".format(meta.datime))
+               nhistos += 1
       return nhistos
 
    def enable_dask_cluster(self, client):
       """
       Enable parallel filling of histograms from a chain of input ROOT
       tree files, using a dask cluster session provided by the user.
+      Each worker of the cluster is prepared once by dask_worker_setup.
       """
+      if dask is None:
+         raise ImportError("treeview.enable_dask_cluster error - " +
+                           "the dask and distributed packages are required, " +
+                           "install them with pip install gluex.jupyroot[dask]")
       self.dask_client = client
+      client.register_worker_callbacks(setup=dask_worker_setup)
+      self._dashboard_link = localhost_pattern.sub(local_fqdn(), client.dashboard_link)
 
-   def fill_histograms(self, maxrows=(1<<63), startrow=0, chunksize=1, accumsize=100, **kwargs):
+   def fill_histograms(self, maxrows=(1<<63), startrow=0, chunksize=1, accumsize=8,
+                       chunkrows=0, nthreads=0, writeback=False, **kwargs):
       """
       Scan over the full chain of input ROOT files and fill all histograms
       that need filling if any, otherwise return immediately. Return value
       is the number of histograms that were updated.
        * maxrows - maximum number of rows to process from the chain, only
-                   applied if parallel dask algorithm is disabled
+                   applied if parallel dask algorithm is disabled, and
+                   ignored by sets declared with declare_rdf_histograms
        * startrow - first row to process from the chain, only
-                   applied if parallel dask algorithm is disabled
+                   applied if parallel dask algorithm is disabled, and
+                   ignored by sets declared with declare_rdf_histograms
+       If ROOT implicit multithreading has been enabled by the user with
+       ROOT.EnableImplicitMT() or with the nthreads argument below and the
+       dask algorithm is disabled, rows are processed in parallel by local
+       threads, see mt_treeplayer; this requires that maxrows and startrow
+       be left at their default values.
+       Any histograms booked with register_histogram that are not yet in
+       the cache are filled in the same RDataFrame pass as the sets from
+       declare_rdf_histograms, and saved to the cache.
        * chunksize - (int) number of input files to process in one dask process,
                    if negative then |chunksize| is the number of processes
                    to dedicate per input file (for processing large files),
-                   only relevant if parallel dask algorithm is enabled
+                   and if zero then it is chosen automatically by timing the
+                   first input file on its worker so that each dask process
+                   runs for about dask_target_tasktime seconds, but with no
+                   fewer processes than the cluster has threads, only
+                   relevant if parallel dask algorithm is enabled;
+                   columnar sets are always read
+                   |chunksize| files per task, at least one
        * accumsize - (int) number of chunks to gather together into a single
                    accumulator step in the sum over parallel dask results,
+                   at least 2, only relevant if parallel dask algorithm is
+                   enabled
+       * chunkrows - (int) if positive then chunksize is ignored, and the
+                   input files are packed into dask processes of about
+                   chunkrows rows each, with files of more than twice that
+                   many rows split over several processes, see pack_rows;
                    only relevant if parallel dask algorithm is enabled
+       * writeback - (bool) if True then the sums of the histograms filled
+                   by the dask workers are written into the cache file by the
+                   worker that does the final sum instead of being sent back
+                   here, which requires that the cache file be on a shared
+                   filesystem at the same path on all of the workers; only
+                   relevant if parallel dask algorithm is enabled
+       * nthreads - (int) if positive and ROOT implicit multithreading is
+                   not already enabled, enable it with this many threads
+                   for the duration of this call, and use it for the
+                   RDataFrame pass too
        * kwargs - any number of user-defined keyword arguments to be passed
-                   to the remote worker for use by the user fill function
+                   to the remote workers, where they are added to the global
+                   namespace of the user fill functions, so that a fill
+                   function can refer to kwarg x simply as x; only relevant
+                   if parallel dask algorithm is enabled
       """
+      if accumsize < 2:
+         raise ValueError("treeview.fill_histograms error - " +
+                          f"accumsize must be at least 2, got {accumsize}")
+      # implicit MT is process-wide, so turn it off again before returning
+      # if it was turned on here
+      mt_enabled_here = nthreads > 0 and not ROOT.IsImplicitMTEnabled()
+      if mt_enabled_here:
+         ROOT.EnableImplicitMT(nthreads)
       workdir = ROOT.TDirectory(self.memorydir.GetName() + "_workspace",
                                 self.memorydir.GetTitle() + "_workspace")
       savedir = ROOT.gDirectory
@@ -312,106 +622,252 @@ class treeview:
          histos['fill_histograms_stats'].Fill(ifile)
       self.declare_histograms("fill_histograms statistics", fill_histograms_hinit, fill_histograms_hfill, leaves=["NULL"])
       ntofill = 0
+      rdf_tofill = []
+      columnar_tofill = {}
+      with cachefile.lock:
+         cached = {key.GetName() for key in self._open_cache().GetListOfKeys()}
       for hset,histodef in self.histodefs.items():
-         histos = histodef['init']()
-         [histos[histo].SetDirectory(0) for histo in histos]
-         with ROOT.TFile.Open(self.savetorootfile) as fsaved:
-            if self.savetorootdir:
-               ROOT.gDirectory.cd(self.savetorootdir)
-            try:
-               histodef['filled'] = {h: ROOT.gDirectory.Get(h) for h in histos}
-               [h.GetTitle() for h in histodef['filled'].values()]
-               histodef['filled'] = {}
-            except:
-               histodef['filled'] = {}
-               histodef['filling'] = histos
-               ntofill += len(histos)
-      if ntofill > 0 and self.dask_client is None:
+         if 'book' in histodef:
+            hnames = histodef['names']
+         else:
+            hnames = list(histodef['protos'])
+         histodef['filled'] = {}
+         if not cached.issuperset(hnames):
+            if 'book' in histodef:
+               rdf_tofill.append(hset)
+            elif 'kernel' in histodef:
+               columnar_tofill[hset] = self._clone_set(hset)
+            else:
+               histodef['filling'] = self._clone_set(hset)
+            ntofill += len(hnames)
+      rowsets = [hset for hset,histodef in self.histodefs.items()
+                 if 'filling' in histodef and hset != "fill_histograms statistics"]
+      if len(rowsets) == 0:
+         statsdef = self.histodefs["fill_histograms statistics"]
+         if 'filling' in statsdef:
+            self._fill_stats(statsdef['filling']['fill_histograms_stats'])
+      elif self.dask_client is None:
          print("found", ntofill, "histograms that need filling,",
                "doing that now in sequential mode...")
          leaves = {leaf: 1 for hdef in self.histodefs.values() for leaf in hdef['leaves']}
+         self.inputchain.SetCacheSize(treecache_size)
+         self.inputchain.SetClusterPrefetch(True)
          if not "*" in leaves:
             self.inputchain.SetBranchStatus("*", 0)
-            for branch in self.inputchain.GetListOfBranches():
-               for leaf in branch.GetListOfLeaves():
-                  if leaf.GetName() in leaves:
-                     self.inputchain.SetBranchStatus(branch.GetName(), 1)
-                     print("enabled branch", branch.GetName())
-         maxrows = min(maxrows, self.inputchain.GetEntries() - startrow)
-         for nrow in range(startrow, startrow + maxrows):
-            self.inputchain.GetEntry(nrow)
-            for hkey,histodef in self.histodefs.items():
-               if 'filling' in histodef:
-                  if hkey == "fill_histograms statistics":
-                     ifile = self.inputchain.GetTreeNumber()
-                     histodef['fill'](ifile, histodef['filling'])
-                  else:
-                     histodef['fill'](self.inputchain, histodef['filling'])
-      elif ntofill > 0:
+            for bname in branches_of_leaves(self.inputchain, leaves):
+               self.inputchain.SetBranchStatus(bname, 1)
+               self.inputchain.AddBranchToCache(bname, True)
+               print("enabled branch", bname)
+         else:
+            self.inputchain.AddBranchToCache("*", True)
+         self.inputchain.StopCacheLearningPhase()
+         nentries = self.inputchain.GetEntries()
+         maxrows = min(maxrows, nentries - startrow)
+         onlyhistos = all(isinstance(h, ROOT.TH1) for hdef in self.histodefs.values()
+                          for h in hdef.get('filling', {}).values())
+         if (ROOT.IsImplicitMTEnabled() and onlyhistos and
+             startrow == 0 and maxrows == nentries):
+            print("using", ROOT.GetThreadPoolSize(), "threads")
+            mt_treeplayer(self.inputchain, self.histodefs, leaves)
+         else:
+            chain = self.inputchain
+            statsdef = self.histodefs["fill_histograms statistics"]
+            sets_filling = [(histodef['fill'], histodef['filling'])
+                            for histodef in self.histodefs.values()
+                            if 'filling' in histodef and histodef is not statsdef]
+            for nrow in range(startrow, startrow + maxrows):
+               chain.GetEntry(nrow)
+               for fill,histos in sets_filling:
+                  fill(chain, histos)
+            if 'filling' in statsdef:
+               self._fill_stats(statsdef['filling']['fill_histograms_stats'],
+                                startrow, startrow + maxrows)
+      else:
          print("found", ntofill, "histograms that need filling,",
                "follow progress on dask monitor dashboard at",
                self.dask_dashboard_link())
-         unique_logdir = f"{os.getcwd()}/{dask_logdir}/{uuid.uuid4().hex}"
+         unique_id = uuid.uuid4().hex
+         unique_logdir = f"{os.getcwd()}/{dask_logdir}/{unique_id}"
          os.makedirs(unique_logdir, exist_ok=False)
-         my_context = f".dask_context_{id(self)}.pkl"
-         with open(my_context, "wb") as contextf:
-             cloudpickle.dump(kwargs, contextf)
+         # send the user kwargs to each worker once, wrapped in a list
+         # so that scatter does not treat the dict as a mapping of keys
+         my_context = self.dask_client.scatter([kwargs], broadcast=True)[0]
          infiles = [link for link in self.inputchain.GetListOfFiles()]
-         if chunksize > 0:
-            results = [dask.delayed(dask_treeplayer)(j, infiles[j:j+chunksize],
-                                    self.histodefs, 
-                                    logdir=unique_logdir,
-                                    context=my_context)
-                       for j in range(0, len(infiles), chunksize)
-                      ]
-         elif chunksize < 0:
-            results = [dask.delayed(dask_treeplayer)(j, infiles[j:j+1],
-                                    self.histodefs, chunk=(i, -chunksize),
-                                    logdir=unique_logdir,
-                                    context=my_context)
-                       for j in range(0, len(infiles))
-                       for i in range(0, -chunksize)
-                      ]
-         else:
-            raise ValueError("hddmview.fill_histogram error -",
-                             "zero chunksize is not allowed in this release")
-         while len(results) > accumsize:
-            results = [dask.delayed(dask_collector)(results[i*accumsize:(i+1)*accumsize])
-                       for i in range((len(results) + accumsize - 1) // accumsize)]
-         lastround = dask.delayed(dask_collector)(results)
-         for hset,histodef in lastround.compute().items():
-            if 'filling' in histodef:
-               self.histodefs[hset]['filling'] = histodef['filling']
-         self.dask_client.cancel(lastround)
-         os.remove(my_context)
+         # workers create their own empty histograms, so ship no TH1 objects,
+         # and send the definitions to each worker once rather than per task
+         histodefs = {hset: {key: histodef[key] for key in ('init', 'fill', 'leaves', 'safe')}
+                      for hset,histodef in self.histodefs.items()
+                      if 'filling' in histodef}
+         histodefs = self.dask_client.scatter([histodefs], broadcast=True)[0]
+         # submit the tasks directly, preferring the worker that read the
+         # same input file on an earlier call, which may still have it open
+         submitted = {}
+         def submit(j, files, chunk=(0,1)):
+            urls = [infile.GetTitle() for infile in files]
+            future = self.dask_client.submit(dask_treeplayer, j, files, histodefs,
+                                             chunk=chunk,
+                                             logdir=unique_logdir,
+                                             context=my_context,
+                                             pool=unique_id,
+                                             workers=self._file_to_worker.get(urls[0]),
+                                             allow_other_workers=True,
+                                             pure=False)
+            submitted[future.key] = urls
+            return future
+         with dask.distributed.get_task_stream(client=self.dask_client) as taskstream:
+            if chunkrows > 0:
+               self.inputchain.GetEntries()
+               offsets = self.inputchain.GetTreeOffset()
+               nrows = [offsets[i+1] - offsets[i] for i in range(len(infiles))]
+               results = [submit(j, infiles[j:j+n], chunk)
+                          for j,n,chunk in pack_rows(nrows, chunkrows)]
+            elif chunksize < 0:
+               results = [submit(j, infiles[j:j+1], (i, -chunksize))
+                          for j in range(0, len(infiles))
+                          for i in range(0, -chunksize)]
+            else:
+               results = []
+               jstart = 0
+               if chunksize == 0:
+                  # calibrate on the first input file, then keep its result
+                  t0 = time.time()
+                  results.append(submit(0, infiles[0:1]))
+                  dask.distributed.wait(results[0])
+                  tperfile = max(dask_task_time(self.dask_client, results[0].key,
+                                                time.time() - t0), 1e-3)
+                  chunksize = max(1, int(dask_target_tasktime / tperfile))
+                  # never make fewer tasks than the cluster can run at once
+                  nslots = sum(self.dask_client.nthreads().values())
+                  chunksize = min(chunksize, max(1, math.ceil((len(infiles) - 1) / nslots)))
+                  print(f"calibration took {tperfile:.1f}s on one input file,",
+                        f"using chunksize={chunksize}")
+                  jstart = 1
+               results += [submit(j, infiles[j:j+chunksize])
+                           for j in range(jstart, len(infiles), chunksize)]
+            writeto = None
+            if writeback:
+               # the worker writes the file, so let go of it here
+               writeto = (os.path.abspath(self.savetorootfile), self.savetorootdir)
+               cachefile.close_cachefile(self.savetorootfile)
+            lastround = self.dask_client.compute(dask_reduce(results, accumsize,
+                                                             pool=unique_id,
+                                                             writeto=writeto))
+            # drop the references to the partial results here so that the
+            # workers can free each one as soon as it has been summed
+            results = None
+            for hset,histodef in lastround.result().items():
+               if writeback:
+                  # already saved, get will read them back when needed
+                  self.histodefs[hset].pop('filling', None)
+               elif 'filling' in histodef:
+                  self.histodefs[hset]['filling'] = histodef['filling']
+            self.dask_client.cancel(lastround)
+         for task in taskstream.data:
+            if task['key'] in submitted:
+               for url in submitted[task['key']]:
+                  self._file_to_worker[url] = [task['worker']]
+         self.dask_client.cancel(my_context)
          for badf in glob.glob(f"{unique_logdir}/*"):
             badfile = badf.split('/')[-1]
             print(f"warning: error processing input file {badfile}")
             os.unlink(badf)
          os.rmdir(unique_logdir)
-      with ROOT.TFile.Open(self.savetorootfile, "update") as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
-         for histodef in self.histodefs.values():
-            if 'filling' in histodef:
-               for h in histodef['filling'].values():
-                  if isinstance(h, ROOT.TTree):
-                     dst_tree = h.CloneTree()
-                     dst_tree.Write()
-                  else:
-                     h.Write()
-                  h.SetDirectory(self.memorydir)
-                  #print("filled histogram", h.GetName(), "with", h.GetEntries(), "entries")
-               histodef['filled'] = histodef['filling']
-               del histodef['filling']
+      if len(columnar_tofill) > 0:
+         print("found", len(columnar_tofill), "columnar histogram sets that need",
+               "filling, doing that now in bulk...")
+         infiles = [(link.GetTitle(), link.GetName())
+                    for link in self.inputchain.GetListOfFiles()]
+         if self.dask_client is None:
+            histodefs = {hset: self.histodefs[hset] for hset in columnar_tofill}
+            for arrays in uproot_iterate(infiles, histodefs):
+               for hset,histos in columnar_tofill.items():
+                  fill_columnar_set(histodefs[hset], histos, arrays)
+            for hset,histos in columnar_tofill.items():
+               self.histodefs[hset]['filling'] = histos
+         else:
+            unique_id = uuid.uuid4().hex
+            histodefs = {hset: {key: self.histodefs[hset][key]
+                                for key in ('init', 'kernel', 'vecfill', 'branches')}
+                         for hset in columnar_tofill}
+            histodefs = self.dask_client.scatter([histodefs], broadcast=True)[0]
+            nfiles_per_task = abs(chunksize) if chunksize else 1
+            results = [dask.delayed(dask_columnar_player)(infiles[j:j+nfiles_per_task],
+                                                          histodefs, pool=unique_id)
+                       for j in range(0, len(infiles), nfiles_per_task)]
+            lastround = dask_reduce(results, accumsize, pool=unique_id)
+            resultsum, = dask.compute(lastround, scheduler=self.dask_client)
+            for hset,histodef in resultsum.items():
+               self.histodefs[hset]['filling'] = histodef['filling']
+      registered = {hname: result for hname,result in self.rdf_results.items()
+                    if not hname in cached and not result.IsReady()}
+      if len(rdf_tofill) > 0 or len(registered) > 0:
+         print("found", len(rdf_tofill), "RDataFrame histogram sets and",
+               len(registered), "registered histograms that need filling,",
+               "doing that now in a single multithreaded pass...")
+         rdf_mt_enabled_here = not ROOT.IsImplicitMTEnabled()
+         if rdf_mt_enabled_here:
+            ROOT.EnableImplicitMT()
+         self.inputchain.SetBranchStatus("*", 1)
+         rdf = ROOT.RDataFrame(self.inputchain)
+         booked = {hset: self.histodefs[hset]['book'](rdf) for hset in rdf_tofill}
+         # run the booked graph together with those of the registered
+         # histograms, which may have been built on other RDataFrames
+         ROOT.RDF.RunGraphs([result for results in booked.values()
+                             for result in results.values()] +
+                            list(registered.values()))
+         if rdf_mt_enabled_here:
+            ROOT.DisableImplicitMT()
+         for hset,results in booked.items():
+            self.histodefs[hset]['filling'] = {hname: result.GetValue().Clone()
+                                               for hname,result in results.items()}
+         for result in registered.values():
+            self.put(result.GetValue())
+         ntofill += len(registered)
+      with cachefile.lock:
+         cache = self._open_cache("update")
+         with ROOT.TDirectory.TContext(cache):
+            for histodef in self.histodefs.values():
+               if 'filling' in histodef:
+                  for h in histodef['filling'].values():
+                     if isinstance(h, ROOT.TTree):
+                        dst_tree = h.CloneTree()
+                        dst_tree.Write()
+                     else:
+                        cache.WriteTObject(h, h.GetName(), "Overwrite")
+                     h.SetDirectory(self.memorydir)
+                     #print("filled histogram", h.GetName(), "with", h.GetEntries(), "entries")
+                  histodef['filled'] = histodef['filling']
+                  del histodef['filling']
+         cachefile.close_cachefile(self.savetorootfile)
       hprocstats = self.get('fill_histograms_stats')
-      nfiles = sum([1 for i in range(nfiles) if hprocstats.GetBinContent(i+1) > 0])
-      nrecords = hprocstats.Integral()
+      counts = hprocstats.GetArray()
+      counts.reshape((hprocstats.GetNcells(),))
+      counts = np.frombuffer(counts, dtype=np.float64)[1:nfiles+1]
+      nfiles = int(np.count_nonzero(counts))
+      nrecords = float(counts.sum())
       print(f"fill_histograms read a total of {nfiles} tree files, {nrecords} records")
       #workdir.ls()
+      if mt_enabled_here:
+         ROOT.DisableImplicitMT()
       savedir.cd()
       return ntofill
 
+   def _fill_stats(self, hstats, firstrow=0, lastrow=(1<<63)):
+      """
+      Fills the fill_histograms_stats histogram hstats with the number of
+      rows in the range [firstrow, lastrow) of the input chain that come
+      from each input file, taken from the tree offsets of the chain
+      instead of filling it once per row.
+      """
+      nentries = self.inputchain.GetEntries()
+      offsets = self.inputchain.GetTreeOffset()
+      lastrow = min(lastrow, nentries)
+      for ifile in range(self.inputchain.GetNtrees()):
+         nrows = min(offsets[ifile + 1], lastrow) - max(offsets[ifile], firstrow)
+         if nrows > 0:
+            hstats.SetBinContent(ifile + 1, nrows)
+      hstats.SetEntries(max(lastrow - firstrow, 0))
+
    def setup_canvas(self, prefix="canvas", width=500, height=400):
       """
       Create a new ROOT canvas for plotting in the output window
@@ -470,8 +926,35 @@ class treeview:
       ROOT.gStyle.SetOptTitle(titles)
       ROOT.gStyle.SetOptStat(stats)
       ROOT.gStyle.SetOptFit(fits)
-      badoption = 0
+      nx, ny, plan = self._normalize_histos(histos, options)
+      cname = self.setup_canvas(width=width*max(nx, 1), height=height*max(ny, 1))
+      if nx > 0:
+         self.current_canvas.Divide(nx, max(ny, 1))
       nhistos = 0
+      found = self._get_many([hname for pad,cell in plan for hname,option in cell])
+      for pad,cell in plan:
+         self.current_canvas.cd(pad)
+         for hname,option in cell:
+            histo = found[hname]
+            if not histo:
+               break
+            histo.Draw(option)
+            nhistos += 1
+            self.drawn_histos[histo.GetName()] = histo
+      self.current_canvas.cd(0)
+      self.current_canvas.Draw()
+      return nhistos
+
+   def _normalize_histos(self, histos, options):
+      """
+      Checks that the histos and options arguments to draw have the same
+      shape and flattens them into a plan for drawing the canvas. Return
+      value is the tuple (nx, ny, plan), where nx and ny are the number
+      of columns and rows the canvas is divided into (0 if not divided)
+      and plan is a list of (pad, cell) pairs, with each cell being the
+      list of (hname, option) pairs to be drawn on that pad, in order.
+      """
+      badoption = 0
       if isinstance(histos, list):
          ny = len(histos)
          if isinstance(options, list):
@@ -506,117 +989,120 @@ class treeview:
          raise ValueError("arguments histos and options must have " +
                           "the same shape if either one of them " +
                           f"is an array or a list ({badoption})")
+      plan = []
       if nx == 0 and ny == 0:
-         cname = self.setup_canvas(width=width, height=height)
          if len(histos) > 0:
-            histo = self.get(histos)
-            if histo:
-               histo.Draw(options)
-               nhistos += 1
-               self.drawn_histos[histo.GetName()] = histo
+            plan.append((0, [(histos, options)]))
       elif ny == 0:
-         cname = self.setup_canvas(width=width*nx, height=height)
-         self.current_canvas.Divide(nx, 1)
          for ix in range(nx):
-            self.current_canvas.cd(ix + 1)
-            histo = self.get(histos[ix])
-            if histo:
-               if isinstance(options, list):
-                  histo.Draw(options[ix])
-               else:
-                  histo.Draw(options)
-               nhistos += 1
-               self.drawn_histos[histo.GetName()] = histo
+            option = options[ix] if isinstance(options, list) else options
+            plan.append((ix + 1, [(histos[ix], option)]))
       else:
-         cname = self.setup_canvas(width=width*nx, height=height*ny)
-         self.current_canvas.Divide(nx, ny)
          for iy in range(ny):
-            for ix in range(nx):
-                try:
-                  self.current_canvas.cd(iy * nx + ix + 1)
+            for ix in range(len(histos[iy])):
+               cell = histos[iy][ix]
+               if not isinstance(cell, list):
+                  cell = [cell]
+               option = options
+               if isinstance(options, list):
+                  try:
+                     option = options[iy][ix]
+                  except IndexError:
+                     continue
                   if isinstance(histos[iy][ix], list):
-                     histo = self.get(histos[iy][ix][0])
-                     if not histo:
-                        pass
-                     elif isinstance(options, list):
-                        histo.Draw(options[iy][ix][0])
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                        for i in range(1,len(histos[iy][ix])):
-                           histo = self.get(histos[iy][ix][i])
-                           histo.Draw(options[iy][ix][0] + " same")
-                           nhistos += 1
-                           self.drawn_histos[histo.GetName()] = histo
-                     else:
-                        histo.Draw(options)
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                        for i in range(1,len(histos[iy][ix])):
-                           histo = self.get(histos[iy][ix][i])
-                           histo.Draw(options + " same")
-                           nhistos += 1
-                           self.drawn_histos[histo.GetName()] = histo
-                  else:
-                     histo = self.get(histos[iy][ix])
-                     if not histo:
-                        pass
-                     elif isinstance(options, list):
-                        histo.Draw(options[iy][ix])
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                     else:
-                        histo.Draw(options)
-                        nhistos += 1
-                        self.drawn_histos[histo.GetName()] = histo
-                except:
-                  pass
-      self.current_canvas.cd(0)
-      self.current_canvas.Draw()
-      return nhistos
+                     option = option[0]
+               plan.append((iy * nx + ix + 1,
+                            [(hname, option + " same" if i > 0 else option)
+                             for i,hname in enumerate(cell)]))
+      return nx, ny, plan
 
-   def get(self, hname):
+   def get(self, hname, meta_only=False):
       """
       Look for histogram named hname in the cache and return if found,
       otherwise look for an empty histogram in the defined histodefs
       with this name and return the empty copy, else report error and
-      return None.
+      return None. If meta_only is True then the histogram is not read,
+      and instead a cachefile.HistoMeta tuple with its name, title,
+      class name, cycle and date taken from the cache file directory is
+      returned, or None if it is not in the cache.
       """
-      with ROOT.TFile(self.savetorootfile) as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
-         try:
-            h = ROOT.gDirectory.Get(hname)
-            if h:
-               h.SetDirectory(self.memorydir)
-            else:
-               raise ValueError(f"histogram {hname} not found")
-            return h
-         except:
-            pass
-      h = None
-      for hset,histoset in self.histodefs.items():
-         for histo in histoset['init']().values():
-            if hname == histo.GetName():
-               h = histo
-               break
-      if h:
-         h.SetDirectory(self.memorydir)
-      return h
+      if meta_only:
+         with cachefile.lock:
+            key = self._open_cache().GetKey(hname)
+            return cachefile.key_meta(key) if key else None
+      return self._get_many([hname])[hname]
+
+   def _get_many(self, hnames):
+      """
+      Looks up each of the histograms named in list hnames the same way
+      as get, reading all of those that are not already in memory from
+      the cache file in one pass under a single hold of the cache lock.
+      Return value is a dict of the results keyed by name.
+      """
+      found = {}
+      with cachefile.lock:
+         cache = None
+         for hname in dict.fromkeys(hnames):
+            hset, proto = self._name_index.get(hname, (None, None))
+            h = self.histodefs[hset]['filled'].get(hname) if hset else None
+            if not h:
+               if cache is None:
+                  cache = self._open_cache()
+               h = self._read_cached(cache, hname)
+               if h:
+                  h.SetDirectory(self.memorydir)
+                  if hset:
+                     self.histodefs[hset]['filled'][hname] = h
+               elif proto:
+                  h = proto.Clone()
+                  h.SetDirectory(self.memorydir)
+            found[hname] = h
+      return found
 
    def put(self, hist):
       """
       Save histogram hist in the cache root directory, and
-      return True for success, False for failure.
+      return True for success, False for failure. The cache file
+      is left open for writing, see flush.
       """
-      with ROOT.TFile(self.savetorootfile, "update") as fsaved:
-         if self.savetorootdir:
-            ROOT.gDirectory.cd(self.savetorootdir)
+      with cachefile.lock:
          try:
-            hist.Write()
+            with ROOT.TDirectory.TContext(self._open_cache("update")):
+               hist.Write()
          except:
             return False
       return True
 
+   def flush(self):
+      """
+      Commits any histograms saved with put to the cache file on disk,
+      leaving it open. Open cache files are also closed automatically
+      when the python interpreter exits.
+      """
+      cachefile.flush_cachefile(self.savetorootfile)
+
+   def _open_cache(self, mode="read"):
+      """
+      Returns the directory in the shared open handle on the cache file
+      where this object saves its histograms, opened in the given mode,
+      see cachefile.open_cachefile. Callers should hold cachefile.lock.
+      """
+      f = cachefile.open_cachefile(self.savetorootfile, mode)
+      if self.savetorootdir:
+         return f.GetDirectory(self.savetorootdir)
+      return f
+
+   def _read_cached(self, cache, hname):
+      """
+      Reads the latest cycle of object hname from directory cache on
+      disk, bypassing any copy left in memory from an earlier read of
+      the same handle, returns None if it is not there.
+      """
+      key = cache.GetKey(hname)
+      if key:
+         return key.ReadObj()
+      return None
+
    def dask_dashboard_link(self):
       """
       The default behavior of the dask client is to provide a local url for
@@ -625,7 +1111,7 @@ class treeview:
       assuming the jupyterhub host is not blocked by internet firewalls.
       """
       if self.dask_client:
-         return re.sub("127.0.0.1", socket.getfqdn(), self.dask_client.dashboard_link)
+         return self._dashboard_link
       else:
          return None
 
@@ -652,108 +1138,439 @@ class treeview:
             else:
                print(f"      '{keyword}':", histodef[keyword])
 
-def dask_treeplayer(j, infiles, histodefs, chunk=(0,1), logdir=None, context=None):
+def mt_treeplayer(chain, histodefs, leaves):
+   """
+   Static member function of treeview, called by fill_histograms to
+   fill histograms from the rows of a ROOT tree chain in parallel on
+   the local host using ROOT implicit multithreading. Each thread fills
+   its own clones of the histograms, which are summed into the originals
+   at the end.
+    1. chain - ROOT TChain with the rows of the input tree
+    2. histodefs - treeview.histodefs structure with lists of TH1
+                   histograms being filled under the key 'filling'.
+    3. leaves - dict with the names of the leaves of the tree that are
+                accessed by the user fill functions, or "*" for all.
+   Return value is the number of rows processed.
+   """
+   fileindex = {link.GetTitle(): i for i,link in enumerate(chain.GetListOfFiles())}
+   def lookup_file(fname):
+      # the name of the open file can differ from the url the chain was
+      # built with, eg. after an xrootd redirect, so fall back on matching
+      # the base file name if that is unambiguous, and report any miss
+      basename = fname.split('?')[0].split('/')[-1]
+      matches = [i for url,i in list(fileindex.items())
+                 if i >= 0 and url.split('?')[0].split('/')[-1] == basename]
+      ifile = matches[0] if len(set(matches)) == 1 else -1
+      if ifile < 0:
+         print(f"warning: input file {fname} not found in the chain,",
+               "its rows are left out of fill_histograms_stats")
+      fileindex[fname] = ifile
+      return ifile
+   filling = [(hset, histodef) for hset,histodef in histodefs.items()
+              if 'filling' in histodef]
+   clones = {}
+   nrows = 0
+   def process_range(reader):
+      nonlocal nrows
+      thread = threading.get_ident()
+      if not thread in clones:
+         clones[thread] = {}
+         for hset,histodef in filling:
+            clones[thread][hset] = {}
+            for hname,h in histodef['filling'].items():
+               clones[thread][hset][hname] = h.Clone()
+               clones[thread][hset][hname].SetDirectory(0)
+      histos = clones[thread]
+      tree = reader.GetTree()
+      if not "*" in leaves:
+         tree.SetBranchStatus("*", 0)
+         for bname in branches_of_leaves(tree, leaves):
+            tree.SetBranchStatus(bname, 1)
+      while reader.Next():
+         tree.GetEntry(reader.GetCurrentEntry())
+         fname = tree.GetCurrentFile().GetName()
+         ifile = fileindex.get(fname)
+         if ifile is None:
+            ifile = lookup_file(fname)
+         for hset,histodef in filling:
+            if hset == "fill_histograms statistics":
+               histodef['fill'](ifile, histos[hset])
+            else:
+               histodef['fill'](tree, histos[hset])
+         nrows += 1
+   # worker threads need the GIL to run the python fill functions
+   ROOT.TTreeProcessorMT.Process.__release_gil__ = True
+   ROOT.TTreeProcessorMT(chain).Process(process_range)
+   for histos in clones.values():
+      for hset,histodef in filling:
+         for hname,h in histodef['filling'].items():
+            h.Add(histos[hset][hname])
+   return nrows
+
+histo_pool = {}
+histo_pool_generation = None
+histo_pool_lock = threading.Lock()
+
+def pooled_histograms(pool, hset, initfunc):
+   """
+   Static member function of treeview, called on a dask worker to get
+   a dict of empty histograms for set hset, reusing a dict that was
+   returned to the worker pool by release_histograms if one is found,
+   otherwise creating a new one with initfunc. The pool argument is a
+   unique identifier for the fill_histograms call being served; any
+   histograms pooled for an earlier call are discarded.
+   """
+   global histo_pool_generation
+   with histo_pool_lock:
+      if histo_pool_generation != pool:
+         histo_pool.clear()
+         histo_pool_generation = pool
+      if histo_pool.get(hset):
+         return histo_pool[hset].pop()
+   histos = initfunc()
+   for h in histos.values():
+      h.SetDirectory(0)
+   return histos
+
+def release_histograms(pool, hset, histos):
+   """
+   Static member function of treeview, called on a dask worker to give
+   back a dict of histograms for set hset whose contents have already
+   been merged into another result, so that the next dask_treeplayer
+   task on this worker can reset and reuse them instead of allocating
+   new ones. Sets containing anything other than TH1 objects are not
+   pooled.
+   """
+   if not all(isinstance(h, ROOT.TH1) for h in histos.values()):
+      return
+   for h in histos.values():
+      h.Reset("ICES")
+   with histo_pool_lock:
+      if histo_pool_generation == pool:
+         histo_pool.setdefault(hset, []).append(histos)
+
+inputfile_cache = OrderedDict()
+inputfile_cache_size = 16
+inputfile_cache_lock = threading.Lock()
+
+def open_inputfile(url):
+   """
+   Static member function of treeview, called on a dask worker to open
+   the input ROOT file at url, taking the handle left open by an earlier
+   task on this worker out of inputfile_cache if one is there, so that
+   retried or overlapping chunks of the same file skip the cost of
+   reopening it. A handle is held by only one task at a time, and it
+   should be given back with release_inputfile when the task is done.
+   """
+   with inputfile_cache_lock:
+      froot = inputfile_cache.pop(url, None)
+   if froot and froot.IsOpen():
+      return froot
+   froot = ROOT.TFile.Open(url)
+   if froot:
+      ROOT.SetOwnership(froot, True)
+   return froot
+
+def release_inputfile(url, froot):
+   """
+   Static member function of treeview, called on a dask worker to give
+   back a handle obtained from open_inputfile to the inputfile_cache,
+   closing the least recently used handles beyond inputfile_cache_size.
+   """
+   with inputfile_cache_lock:
+      inputfile_cache[url] = froot
+      while len(inputfile_cache) > inputfile_cache_size:
+         inputfile_cache.popitem(last=False)[1].Close()
+
+def pack_rows(nrows, chunkrows):
+   """
+   Static member function of treeview, called by fill_histograms to
+   divide the input files with row counts in list nrows into dask tasks
+   of about chunkrows rows each. Runs of consecutive small files are
+   grouped into one task until they reach chunkrows, and any file with
+   more than 2*chunkrows rows is split into slices of about chunkrows.
+   Return value is a list of (j, n, chunk) tuples, one per task, where
+   j is the index of the first file, n is the number of files and chunk
+   is the (n,N) slice argument to dask_treeplayer.
+   """
+   tasks = []
+   jfirst = 0
+   rows = 0
+   for j,n in enumerate(nrows):
+      if n > 2 * chunkrows:
+         if j > jfirst:
+            tasks.append((jfirst, j - jfirst, (0, 1)))
+         nslices = math.ceil(n / chunkrows)
+         tasks += [(j, 1, (i, nslices)) for i in range(nslices)]
+         jfirst = j + 1
+         rows = 0
+         continue
+      rows += n
+      if rows >= chunkrows:
+         tasks.append((jfirst, j + 1 - jfirst, (0, 1)))
+         jfirst = j + 1
+         rows = 0
+   if jfirst < len(nrows):
+      tasks.append((jfirst, len(nrows) - jfirst, (0, 1)))
+   return tasks
+
+def dask_task_time(client, key, elapsed):
+   """
+   Static member function of treeview, called by fill_histograms to
+   look up in the scheduler task stream the time that the task with
+   the given key spent computing on its worker, which leaves out the
+   scheduling and transfer overheads seen from the client. The task
+   stream only goes back as far as elapsed seconds plus a margin, and
+   elapsed is returned if the task is not found there.
+   """
+   for task in client.get_task_stream(start=f"{elapsed + 10:.0f}s"):
+      if task['key'] == key:
+         return sum(ss['stop'] - ss['start'] for ss in task['startstops']
+                    if ss['action'] == 'compute')
+   return elapsed
+
+def dask_worker_setup():
+   """
+   Static member function of treeview, registered by enable_dask_cluster
+   to run once on every dask worker of the cluster, including workers
+   that join later. It enables ROOT thread safety, because a worker runs
+   several dask_treeplayer tasks at once in its threads, and sets the
+   xrootd stream timeout to xrd_stream_timeout seconds unless the user
+   has set XRD_STREAMTIMEOUT in the worker environment. The environment
+   variable is read when the xrootd client on the worker is initialized,
+   so the live setting is also updated through the XRootD client bindings
+   for workers where that has already happened. Failure to set the live
+   timeout is logged and does not stop the worker from being used.
+   """
+   ROOT.EnableThreadSafety()
+   if not "XRD_STREAMTIMEOUT" in os.environ:
+      os.environ["XRD_STREAMTIMEOUT"] = str(xrd_stream_timeout)
+      try:
+         xclient.EnvPutInt("StreamTimeout", xrd_stream_timeout)
+      except Exception as e:
+         logger.warning(f"dask_worker_setup cannot set the xrootd stream timeout: {e!r}")
+
+def inject_context(histodefs, context):
+   """
+   Static member function of treeview, called on a dask worker to make
+   the user kwargs of fill_histograms in dict context visible to the
+   user fill functions in histodefs, by adding them to the global
+   namespace of each fill function as it exists on the worker. The
+   internal fill_histograms statistics set is skipped.
+   """
+   for hset,histodef in histodefs.items():
+      fill = histodef.get('fill')
+      if hset != "fill_histograms statistics" and hasattr(fill, "__globals__"):
+         fill.__globals__.update(context)
+
+def dask_treeplayer(j, infiles, histodefs, chunk=(0,1), logdir=None, context=None,
+                    pool=None):
    """
    Static member function of treeview, called with dask_delayed
    to fill histograms from ROOT tree input files in parallel on
    a dask cluster.
     1. j - (int) starting index of file for this process
     2. infiles - list of name and path or url to the input ROOT tree
-    3. histodefs - copy of treeview.histodefs structure with lists of TH1
-                   histograms being filled under the key 'filling'.
+    3. histodefs - copy of treeview.histodefs structure restricted to the
+                   histogram sets that need filling, without histograms,
+                   shared read-only with the other tasks on this worker.
     4. chunk - [int, int] is defined as the pair (n,N) where N is the 
                  number of subdivisions of the total row count of the tree
                  in this input file, and n is the index in [0,N) of the
                  slice of rows in this input file to be processed.
     5. logdir - path of a directory to save logs of any input files
                 that generated errors or crashed during processing.
-    6. context - name of a pickle file with a readonly dict containing
-                 variables that are needed by the user fill function.
-   Return value is the updated histodefs from argument 3.
+    6. context - readonly dict, scattered to the workers, of the user
+                 kwargs to fill_histograms, which are made visible to the
+                 user fill functions as globals, see inject_context.
+    7. pool - unique identifier of the fill_histograms call, used as the
+              key for reusing histograms on this worker, see
+              pooled_histograms.
+   Return value is a dict keyed by the set names in histodefs, with
+   the filled histograms of each set under the key 'filling'.
    """
    if context:
-      with open(context, "rb") as contextf:
-         kwargs = cloudpickle.load(contextf)
-         locals().update(kwargs)
-   def loop_over_rows(infile):
-      nerrors = 0
-      froot = ROOT.TFile.Open(infile.GetTitle())
+      inject_context(histodefs, context)
+   histodefs = {hset: dict(histodef, filling=pooled_histograms(pool, hset, histodef['init']))
+                for hset,histodef in histodefs.items()}
+   def loop_over_rows(infile, froot, nerrors):
+      # nerrors belongs to the caller so that the counts by set survive
+      # when fill_error_limit is passed and the exception is re-raised
       tree = froot.Get(infile.GetName())
-      tree.SetCacheSize(0)
       nentries = tree.GetEntries()
       nentries_per_slice = math.ceil(nentries / chunk[1])
       nstart = nentries_per_slice * chunk[0]
       nend = min(nentries, nstart + nentries_per_slice)
       leaves = {leaf: 1 for hdef in histodefs.values() for leaf in hdef['leaves']}
-      if not "*" in leaves:
-         tree.SetBranchStatus("*", 0)
+      tree.SetBranchStatus("*", int("*" in leaves))
       buffers = {}
       master_buffer = {}
-      for branch in tree.GetListOfBranches():
-         for leaf in branch.GetListOfLeaves():
-            lname = leaf.GetName()
-            if lname in leaves:
-               bname = branch.GetName()
-               if not bname in buffers:
-                  bform = branch.GetTitle()
-                  dtype_list = parse_root_struct_to_dtype(bform)
-                  buffers[bname] = np.zeros(1, dtype=dtype_list)
-                  tree.SetBranchStatus(bname, 1)
-                  baddr = buffers[bname].__array_interface__['data'][0]
-                  branch.SetAddress(ctypes.c_void_p(baddr))
-               master_buffer[lname] = buffers[bname][0][lname]
+      leafmap = leaf_branches(tree)
+      for lname in leaves:
+         branch = leafmap.get(lname)
+         if branch:
+            bname = branch.GetName()
+            if not bname in buffers:
+               bform = branch.GetTitle()
+               dtype_list = parse_root_struct_to_dtype(bform)
+               buffers[bname] = np.zeros(1, dtype=dtype_list)
+               tree.SetBranchStatus(bname, 1)
+               baddr = buffers[bname].__array_interface__['data'][0]
+               branch.SetAddress(ctypes.c_void_p(baddr))
+            master_buffer[lname] = buffers[bname][0][lname]
+      tree.SetCacheSize(treecache_size)
+      if "*" in leaves:
+         tree.AddBranchToCache("*", True)
+      else:
+         for bname in buffers:
+            tree.AddBranchToCache(bname, True)
+      tree.StopCacheLearningPhase()
       rowdata = SimpleNamespace(**master_buffer)
+      statsdef = histodefs.get("fill_histograms statistics")
+      safe = [(histodef['fill'], histodef['filling'])
+              for hset,histodef in histodefs.items()
+              if histodef['safe'] and histodef is not statsdef]
+      checked = [(hset, histodef['fill'], histodef['filling'])
+                 for hset,histodef in histodefs.items()
+                 if not histodef['safe'] and histodef is not statsdef]
       for row in range(nstart, nend):
          tree.GetEntry(row)
-         for hset,histodef in histodefs.items():
-            if hset == "fill_histograms statistics":
-               histodef['fill'](j, histodef['filling'])
-            elif 'filling' in histodef:
-               try:
-                  histodef['fill'](rowdata, histodef['filling'])
-               except:
-                  nerrors += 1
+         if statsdef:
+            statsdef['fill'](j, statsdef['filling'])
+         for fill,histos in safe:
+            fill(rowdata, histos)
+         for hset,fill,histos in checked:
+            try:
+               fill(rowdata, histos)
+            except Exception:
+               nerrors[hset] = nerrors.get(hset, 0) + 1
+               if nerrors[hset] > fill_error_limit:
+                  raise
       tree.ResetBranchAddresses()
-      froot.Close()
-      return nerrors
    for infile in infiles:
+      nerrors = {}
+      froot = None
       try:
-         nerrors = loop_over_rows(infile)
-      except:
-         nerrors = 1
-      if logdir and nerrors > 0:
-         with open(f"{logdir}/dask_treemaker.err", "a") as logf:
-            logf.write(f"{nerrors} errors occurred during " +
-                       f"processing of input file {infile}\n")
+         froot = open_inputfile(infile.GetTitle())
+         if not froot:
+            raise OSError(f"cannot open input file {infile.GetTitle()}")
+         loop_over_rows(infile, froot, nerrors)
+         release_inputfile(infile.GetTitle(), froot)
+         froot = None
+      except Exception as e:
+         logger.error(f"dask_treeplayer abandoned input file {infile.GetTitle()}: {e!r}")
+         nerrors["*"] = nerrors.get("*", 0) + 1
+      finally:
+         # an abandoned file is closed rather than given back for reuse,
+         # which also deletes its tree along with the branch addresses
+         if froot:
+            froot.Close()
+      if nerrors:
+         message = (f"{sum(nerrors.values())} errors occurred during processing " +
+                    f"of input file {infile.GetTitle()}, by set {nerrors}")
+         logger.warning(message)
+         if logdir:
+            with open(f"{logdir}/dask_treemaker.err", "a") as logf:
+               logf.write(message + "\n")
       j += 1
    if False:
       global treeplayer_task_id
       treeplayer_task_id += 1
       log_worker_stats(treeplayer_task_id, nerrors, "dask_treeplayer")
-   return histodefs
+   return {hset: {'filling': histodef['filling']} for hset,histodef in histodefs.items()}
+
+def dask_columnar_player(infiles, histodefs, pool=None):
+   """
+   Static member function of treeview, called with dask_delayed
+   to fill columnar histogram sets from ROOT tree input files in
+   parallel on a dask cluster, reading them with uproot.
+    1. infiles - list of (filename, treename) pairs to be read
+    2. histodefs - copy of treeview.histodefs structure restricted to
+                   the columnar histogram sets that need filling, shared
+                   read-only with the other tasks on this worker
+    3. pool - unique identifier of the fill_histograms call, used as the
+              key for reusing histograms on this worker, see
+              pooled_histograms.
+   Return value is a dict keyed by the set names in histodefs, with
+   the filled histograms of each set under the key 'filling'.
+   """
+   results = {hset: {'filling': pooled_histograms(pool, hset, histodef['init'])}
+              for hset,histodef in histodefs.items()}
+   for arrays in uproot_iterate(infiles, histodefs):
+      for hset,histodef in histodefs.items():
+         fill_columnar_set(histodef, results[hset]['filling'], arrays)
+   return results
+
+def dask_reduce(results, accumsize, pool=None, writeto=None):
+   """
+   Static member function of treeview, builds a balanced tree of
+   dask_delayed dask_collector steps that sums the list of delayed
+   results, with no more than accumsize inputs to any one step, so
+   that the depth of the tree grows only as log(len(results)) and
+   no single worker ever holds more than accumsize partial sums.
+   The accumsize must be at least 2 for the tree to get shallower.
+   If writeto is given as a pair (savefile, savedir) then the final
+   step is dask_collector_write instead, see there.
+   Return value is the delayed object for the final sum.
+   """
+   if len(results) > accumsize:
+      step = math.ceil(len(results) / accumsize)
+      results = [dask_reduce(results[i:i+step], accumsize, pool=pool)
+                 for i in range(0, len(results), step)]
+   if writeto:
+      return dask.delayed(dask_collector_write)(results, *writeto, pool=pool)
+   return dask.delayed(dask_collector)(results, pool=pool)
 
-def dask_collector(results):
+def dask_collector_write(results, savefile, savedir, pool=None):
+   """
+   Static member function of treeview, called with dask_delayed as
+   the final step of dask_reduce to sum the results like dask_collector
+   and then write the sums directly from the worker into directory
+   savedir of the ROOT file at savefile, which must be visible to the
+   worker at that path, instead of sending them back to the client.
+   Return value is a dict keyed by set name of the lists of the names
+   of the objects that were written.
+   """
+   resultsum = dask_collector(results, pool=pool)
+   with ROOT.TDirectory.TContext():
+      fsaved = ROOT.TFile.Open(savefile, "update")
+      fsaved.SetCompressionSettings(cachefile.compression)
+      outdir = fsaved.GetDirectory(savedir) if savedir else fsaved
+      outdir.cd()
+      for histodef in resultsum.values():
+         for h in histodef.get('filling', {}).values():
+            if isinstance(h, ROOT.TTree):
+               h.CloneTree().Write()
+            else:
+               outdir.WriteTObject(h, h.GetName(), "Overwrite")
+      fsaved.Close()
+   return {hset: list(histodef.get('filling', {}))
+           for hset,histodef in resultsum.items()}
+
+def dask_collector(results, pool=None):
    """
    Static member function of treeview, called with dask_delayed
    to sum a list of histogram sets formed from the return values
    of dask_treeplayer instances run in parallel on a dask cluster.
+   If pool is given, the histograms that were summed into the first
+   result are handed back to the worker pool for reuse.
    Return value is the sum of the individual results.
    """
    resultsum = results[0]
    for hset in resultsum:
       if 'filling' in resultsum[hset]:
-         for h in resultsum[hset]['filling']:
-            if isinstance(resultsum[hset]['filling'][h], ROOT.TTree):
-               tree_one = resultsum[hset]['filling'][h]
-               dst_tree = tree_one.CloneTree(0)
-               for result in results[1:]:
-                  src_tree = result[hset]['filling'][h]
-                  tree_one.CopyAddresses(src_tree)
-                  for row in src_tree:
-                     tree_one.Fill()
-            else:
-               for result in results[1:]:
-                  resultsum[hset]['filling'][h].Add(result[hset]['filling'][h])
+         fillings = [result[hset]['filling'] for result in results[1:]]
+         for h,dst in resultsum[hset]['filling'].items():
+            # TH1::Merge sums the bin contents, TTree::Merge appends the rows
+            others = ROOT.TList()
+            for filling in fillings:
+               others.Add(filling[h])
+            dst.Merge(others)
+   if pool:
+      for result in results[1:]:
+         for hset,histodef in result.items():
+            if 'filling' in histodef:
+               release_histograms(pool, hset, histodef['filling'])
    if False:
       global collector_task_id
       collector_task_id += 1